@@ -5,8 +5,19 @@ Uses: PDF Processing, Tavily Search, and OpenRouter LLM
 
 import streamlit as st
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator
+import hashlib
+import math
+import shutil
+import glob
 import tempfile
+import atexit
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import tiktoken
+import numpy as np
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -17,12 +28,29 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 # LangChain imports
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+import faiss
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_openai import ChatOpenAI
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain.schema import HumanMessage, SystemMessage
+from langchain_core.embeddings import Embeddings
+from langchain.schema import Document, HumanMessage, SystemMessage
+
+# PDF parsing (PyMuPDF)
+import fitz
+
+# ONNX Runtime imports (INT8 embedding inference)
+import onnxruntime as ort
+from transformers import AutoTokenizer
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+# Split CPU cores between FAISS (OpenMP) and ONNX Runtime so concurrent
+# uploads and queries don't oversubscribe them
+CPU_COUNT = os.cpu_count() or 4
+FAISS_THREADS = max(1, CPU_COUNT // 2)
+ONNX_THREADS = max(1, CPU_COUNT // 2)
+faiss.omp_set_num_threads(FAISS_THREADS)
 
 # Page configuration
 st.set_page_config(
@@ -76,6 +104,12 @@ with st.sidebar:
 
     temperature = st.slider("Temperature", 0.0, 1.0, 0.3)
 
+    web_search_threshold = st.slider(
+        "Web Search Threshold",
+        0.0, 1.0, 0.6,
+        help="Skip web search when the best PDF match is at least this similar to the question"
+    )
+
     st.markdown("---")
     st.markdown("""
     ### 📖 How to Use:
@@ -96,97 +130,479 @@ if 'embeddings' not in st.session_state:
     st.session_state.embeddings = None
 
 
+# Embedding model settings
+EMBEDDING_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+EMBEDDING_MAX_LENGTH = 256
+EMBEDDING_BATCH_SIZE = 64
+ONNX_MODEL_DIR = os.path.join(".cache", "onnx", "all-MiniLM-L6-v2-int8")
+ONNX_MODEL_FILE = "model_quantized.onnx"
+
+
+def mean_pool(last_hidden_state: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """Mean-pool token embeddings over real tokens, then L2-normalize"""
+    hidden = last_hidden_state.astype(np.float32, copy=False)
+    mask = attention_mask.astype(np.float32)
+
+    # (batch, 1, seq) @ (batch, seq, dim): masked sum as one batched GEMM,
+    # without materializing a masked copy of the hidden states
+    pooled = np.matmul(mask[:, None, :], hidden)[:, 0, :]
+    pooled /= np.maximum(mask.sum(axis=1, keepdims=True), 1e-9)
+    pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+    return pooled
+
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence embeddings from an INT8-quantized ONNX Runtime session"""
+
+    def __init__(self, model_dir: str):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = ONNX_THREADS
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_FILE),
+            sess_options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _run(self, encoded) -> np.ndarray:
+        inputs = {k: v for k, v in encoded.items() if k in self.input_names}
+        last_hidden_state = self.session.run(None, inputs)[0]
+        return mean_pool(last_hidden_state, encoded["attention_mask"])
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        # Tokenize once without padding so we know each text's length
+        encoded = self.tokenizer(texts, truncation=True, max_length=EMBEDDING_MAX_LENGTH)
+        features = [{k: encoded[k][i] for k in encoded.keys()} for i in range(len(texts))]
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+
+        # Batch similar-length texts together and pad each batch only to its longest text
+        order = np.argsort(lengths)
+        vectors = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for start in range(0, len(order), EMBEDDING_BATCH_SIZE):
+            batch = order[start:start + EMBEDDING_BATCH_SIZE]
+            padded = self.tokenizer.pad(
+                [features[i] for i in batch],
+                padding="longest",
+                return_tensors="np"
+            )
+            vectors[batch] = self._run(padded)
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        encoded = self.tokenizer(
+            [text],
+            truncation=True,
+            max_length=EMBEDDING_MAX_LENGTH,
+            return_tensors="np"
+        )
+        return self._run(encoded)[0].tolist()
+
+
+def export_quantized_model(model_dir: str):
+    """Export the embedding model to ONNX and apply INT8 dynamic quantization"""
+    # Export into a sibling directory and move it into place once complete,
+    # so an interrupted export never leaves a half-written model_dir behind
+    tmp_dir = f"{model_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    AutoTokenizer.from_pretrained(EMBEDDING_MODEL_ID).save_pretrained(tmp_dir)
+    model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL_ID, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=tmp_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+
+    # Clear out any partial export left by an older version of this function
+    shutil.rmtree(model_dir, ignore_errors=True)
+    os.replace(tmp_dir, model_dir)
+
+
 @st.cache_resource
 def get_embeddings():
     """Get or create embeddings model (cached)"""
-    return HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'},
-        encode_kwargs={'normalize_embeddings': True}
+    if not os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+        export_quantized_model(ONNX_MODEL_DIR)
+    return OnnxEmbeddings(ONNX_MODEL_DIR)
+
+
+@st.cache_resource
+def get_executor():
+    """Get the shared thread pool for background work (cached)"""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_resource
+def start_embeddings_warmup():
+    """Load the embeddings model in the background once per process (cached)"""
+    return get_executor().submit(get_embeddings)
+
+
+# Pre-warm the embeddings model so it is ready by the time a PDF is uploaded
+start_embeddings_warmup()
+
+
+# Vector index settings
+IVF_PQ_MIN_CHUNKS = 1000  # below this an IVF-SQ8 index probing every cell is fast enough
+PQ_SUBQUANTIZERS = 32     # 384 / 32 = 12 dims per sub-vector, 32 bytes/vector
+
+
+def wrap_index(index, splits, embeddings):
+    """Wrap a raw FAISS index and its chunks into a LangChain vector store"""
+    # build_index only creates inner-product indexes over normalized embeddings
+    assert index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore({str(i): doc for i, doc in enumerate(splits)}),
+        index_to_docstore_id={i: str(i) for i in range(len(splits))},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
     )
 
 
-def process_pdf(pdf_file) -> tuple:
-    """Process uploaded PDF and create vector store"""
-    try:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(pdf_file.getvalue())
-            tmp_path = tmp_file.name
-
-        # Load PDF
-        loader = PyPDFLoader(tmp_path)
-        documents = loader.load()
-
-        if not documents:
-            st.error("Could not extract text from PDF")
-            return None, 0
-
-        # Split text
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len
+def build_index(splits, embeddings):
+    """Embed the chunks and build a FAISS index, using IVF-PQ for large documents"""
+    # Embed all chunks in one call so the embedder can batch them
+    xb = np.asarray(
+        embeddings.embed_documents([s.page_content for s in splits]),
+        dtype="float32"
+    )
+
+    # Embeddings are L2-normalized, so inner product ranks the same as L2
+    # distance while mapping straight onto FAISS's GEMM kernels
+    if len(splits) < IVF_PQ_MIN_CHUNKS:
+        # 8-bit scalar-quantized vectors (4x smaller than FP32); IVF so GPU
+        # FAISS can clone it, probing every cell to keep the search exhaustive
+        nlist = max(1, int(math.sqrt(len(splits))))
+        quantizer = faiss.IndexFlatIP(EMBEDDING_DIM)
+        index = faiss.IndexIVFScalarQuantizer(
+            quantizer,
+            EMBEDDING_DIM,
+            nlist,
+            faiss.ScalarQuantizer.QT_8bit,
+            faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(xb)
+        index.nprobe = nlist
+    else:
+        # Partition into Voronoi cells and product-quantize the vectors
+        nlist = max(4, int(4 * math.sqrt(len(splits))))
+        index = faiss.index_factory(
+            EMBEDDING_DIM,
+            f"IVF{nlist},PQ{PQ_SUBQUANTIZERS}x8",
+            faiss.METRIC_INNER_PRODUCT
         )
-        splits = text_splitter.split_documents(documents)
+        index.train(xb)
+        index.nprobe = min(nlist, 8)
+    index.add(xb)
 
-        # Get cached embeddings
-        embeddings = get_embeddings()
+    # Let IVF indexes reconstruct stored vectors (needed for MMR search)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index
+
+
+@st.cache_resource
+def get_gpu_resources():
+    """Get the FAISS GPU resources, or None without a CUDA-enabled FAISS build (cached)"""
+    try:
+        if faiss.get_num_gpus() == 0:
+            return None
+        return faiss.StandardGpuResources()
+    except Exception:
+        return None
+
+
+@st.cache_resource
+def get_gpu_lock():
+    """Get the lock serializing searches on shared GPU indexes (cached)"""
+    return threading.Lock()
+
+
+def is_gpu_index(index) -> bool:
+    """Check whether a FAISS index lives on the GPU"""
+    return hasattr(faiss, "GpuIndex") and isinstance(index, faiss.GpuIndex)
+
+
+def index_to_gpu(index):
+    """Move a FAISS index onto the first GPU when one is available"""
+    res = get_gpu_resources()
+    if res is None:
+        return index
+
+    try:
+        co = faiss.GpuClonerOptions()
+        # Keep IVF-PQ lookup tables small enough for GPU shared memory
+        co.useFloat16LookupTables = True
+        return faiss.index_cpu_to_gpu(res, 0, index, co)
+    except Exception:
+        return index
+
+
+def split_pdf(pdf_bytes: bytes) -> list:
+    """Extract text from a PDF and split it into chunks"""
+    # Parse directly from memory, no temp file needed
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        documents = [
+            Document(page_content=page.get_text("text"), metadata={"page": i})
+            for i, page in enumerate(doc)
+        ]
+
+    if not documents:
+        return []
+
+    # Split text
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=200,
+        length_function=len
+    )
+    return text_splitter.split_documents(documents)
 
-        # Create vector store
-        vectorstore = FAISS.from_documents(splits, embeddings)
 
-        # Clean up temp file
-        os.unlink(tmp_path)
+INDEX_CACHE_DIR = os.path.join(".cache", "faiss")
+# Bump whenever text extraction, chunking or the index type changes, so
+# indexes persisted by older builds are not paired with different chunks
+INDEX_FORMAT_VERSION = 2
 
-        return vectorstore, len(splits)
+
+def read_index(path: str):
+    """Read a persisted FAISS index, memory-mapping it where supported"""
+    # IVF indexes are mapped read-only, so pages load lazily and are shared
+    # between processes through the page cache; FAISS ignores the flag for
+    # other index types and reads them normally. Corrupt files raise here.
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def write_index(index, path: str):
+    """Persist a FAISS index atomically, then drop older versions for the same PDF"""
+    # Unique temp name so concurrent workers indexing the same PDF never share
+    # a file, and a killed process can't leave a partial index at path
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    # Indexes from earlier INDEX_FORMAT_VERSIONs (or unversioned ones) are never read again
+    digest = os.path.basename(path).split("-v")[0]
+    stale = glob.glob(os.path.join(INDEX_CACHE_DIR, f"{digest}-v*.faiss"))
+    stale.append(os.path.join(INDEX_CACHE_DIR, f"{digest}.faiss"))
+    for stale_path in stale:
+        if stale_path != path:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_vectorstore(digest: str, _pdf_bytes: bytes):
+    """Get or create the vector store for a PDF (cached by content digest)"""
+    splits = split_pdf(_pdf_bytes)
+    if not splits:
+        raise ValueError("Could not extract text from PDF")
+
+    # Get cached embeddings
+    embeddings = get_embeddings()
+
+    # Reuse an index persisted by an earlier run of the same build; chunking is
+    # deterministic, so the chunks line up with the stored vectors
+    index_path = os.path.join(INDEX_CACHE_DIR, f"{digest}-v{INDEX_FORMAT_VERSION}.faiss")
+    index = None
+    if os.path.exists(index_path):
+        try:
+            index = read_index(index_path)
+        except Exception:
+            # Unreadable (e.g. truncated) files are rebuilt and overwritten
+            index = None
+        # Backstop against a mismatched index the version bump didn't catch
+        if index is not None and index.ntotal != len(splits):
+            index = None
+
+    if index is None:
+        # Create the index and persist it (from CPU, before any GPU transfer)
+        index = build_index(splits, embeddings)
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        write_index(index, index_path)
+
+    return wrap_index(index_to_gpu(index), splits, embeddings)
+
+
+def process_pdf(pdf_file) -> tuple:
+    """Process uploaded PDF and create vector store"""
+    try:
+        pdf_bytes = pdf_file.getvalue()
+        digest = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+        vectorstore = load_vectorstore(digest, pdf_bytes)
+        return vectorstore, vectorstore.index.ntotal
 
     except Exception as e:
         st.error(f"Error processing PDF: {str(e)}")
         return None, 0
 
 
-def search_pdf(vectorstore, query: str, k: int = 4) -> str:
-    """Search the PDF and return relevant context"""
+# Chunks whose 5-word shingles overlap more than this are treated as duplicates
+DUPLICATE_JACCARD_THRESHOLD = 0.7
+
+
+def get_shingles(text: str, size: int = 5) -> set:
+    """Hash the overlapping word windows of a text"""
+    words = text.split()
+    return {hash(" ".join(words[i:i + size])) for i in range(max(1, len(words) - size + 1))}
+
+
+def dedupe_docs(docs: list) -> list:
+    """Drop documents that are near-duplicates of an earlier one"""
+    kept, kept_shingles = [], []
+    for doc in docs:
+        shingles = get_shingles(doc.page_content)
+        if any(
+            len(shingles & other) / max(1, len(shingles | other)) > DUPLICATE_JACCARD_THRESHOLD
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def search_pdf(vectorstore, query: str, k: int = 4) -> tuple:
+    """Search the PDF and return relevant context with its best similarity score"""
     if vectorstore is None:
-        return None
+        return None, None
     
     try:
-        docs = vectorstore.similarity_search(query, k=k)
-        if not docs:
-            return None
+        embedding = vectorstore.embeddings.embed_query(query)
+        # Cached vector stores are shared by all sessions, and FAISS GPU indexes
+        # (and their GpuResources) are not thread-safe
+        lock = get_gpu_lock() if is_gpu_index(vectorstore.index) else nullcontext()
+        with lock:
+            try:
+                # MMR favours chunks that add new information over overlapping neighbours
+                results = vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                    embedding, k=k, fetch_k=20, lambda_mult=0.5
+                )
+            except RuntimeError:
+                # Indexes that cannot reconstruct vectors (e.g. IVF on GPU) fall back to plain search
+                results = vectorstore.similarity_search_with_score_by_vector(embedding, k=k)
+        if not results:
+            return None, None
         
+        # Inner product of normalized embeddings is already cosine similarity
+        max_score = max(score for _, score in results)
+        docs = dedupe_docs([doc for doc, _ in results])
         context = "\n\n---\n\n".join([doc.page_content for doc in docs])
-        return context
+        return context, max_score
     except Exception as e:
         st.error(f"Error searching PDF: {str(e)}")
-        return None
+        return None, None
+
+
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
 
 
-def search_web(tavily_key: str, query: str) -> str:
-    """Search the web using Tavily"""
+@st.cache_resource
+def get_tavily_client():
+    """Get or create the pooled HTTP/2 client for Tavily (cached)"""
+    client = httpx.Client(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=10),
+        headers={"Content-Type": "application/json"}
+    )
+    atexit.register(client.close)
+    return client
+
+
+def search_web(client: httpx.Client, tavily_key: str, query: str) -> str:
+    """Search the web using Tavily (safe to run off the script thread)"""
     try:
-        tavily = TavilySearchResults(api_key=tavily_key, max_results=3)
-        results = tavily.run(query)
-        return str(results)
+        response = client.post(
+            TAVILY_SEARCH_URL,
+            json={"api_key": tavily_key, "query": query, "max_results": 3}
+        )
+        response.raise_for_status()
+        # Keep only the fields the LLM needs instead of the raw JSON
+        results = [
+            f"{r.get('title', '')}\n{r.get('content', '')}"
+            for r in response.json().get("results", [])
+        ]
+        return "\n\n---\n\n".join(results)
     except Exception as e:
         return f"Web search error: {str(e)}"
 
 
-def get_answer(llm, question: str, pdf_context: Optional[str], web_context: Optional[str]) -> str:
-    """Get answer from LLM using available context"""
+@st.cache_resource
+def get_llm(api_key: str, model: str, temperature: float):
+    """Get or create the OpenRouter chat client (cached per key/model/temperature)"""
+    return ChatOpenAI(
+        openai_api_key=api_key,
+        openai_api_base="https://openrouter.ai/api/v1",
+        model_name=model,
+        temperature=temperature,
+        streaming=True,
+        default_headers={
+            "HTTP-Referer": "http://localhost:8501",
+            "X-Title": "Agentic RAG System"
+        }
+    )
+
+
+# Prompt token budgets per context source
+PDF_CONTEXT_TOKENS = 3000
+WEB_CONTEXT_TOKENS = 1500
+
+
+@st.cache_resource
+def get_token_encoding():
+    """Get the tiktoken encoding used to budget prompt context (cached)"""
+    return tiktoken.encoding_for_model("gpt-4o")
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Trim text to at most max_tokens tokens"""
+    encoding = get_token_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def get_source_label(pdf_context: Optional[str], web_context: Optional[str]) -> str:
+    """Describe which sources an answer was based on"""
+    sources_used = []
+    if pdf_context:
+        sources_used.append("PDF")
+    if web_context:
+        sources_used.append("Web")
+    return " & ".join(sources_used) if sources_used else "AI"
+
+
+def get_answer(llm, question: str, pdf_context: Optional[str], web_context: Optional[str]) -> Iterator[str]:
+    """Stream the answer from LLM using available context"""
     
     # Build context section
     context_parts = []
-    sources_used = []
     
     if pdf_context:
+        pdf_context = truncate_to_tokens(pdf_context, PDF_CONTEXT_TOKENS)
         context_parts.append(f"=== DOCUMENT CONTENT ===\n{pdf_context}")
-        sources_used.append("PDF")
     
     if web_context:
+        web_context = truncate_to_tokens(web_context, WEB_CONTEXT_TOKENS)
         context_parts.append(f"=== WEB SEARCH RESULTS ===\n{web_context}")
-        sources_used.append("Web")
     
     context = "\n\n".join(context_parts) if context_parts else "No context available."
     
@@ -204,11 +620,8 @@ RULES:
         HumanMessage(content=f"Context:\n{context}\n\n---\n\nQuestion: {question}")
     ]
     
-    response = llm.invoke(messages)
-    
-    # Add source indicator
-    source_label = " & ".join(sources_used) if sources_used else "AI"
-    return f"{response.content}\n\n*Source: {source_label}*"
+    for chunk in llm.stream(messages):
+        yield chunk.content
 
 
 # Main content area
@@ -274,38 +687,37 @@ if question := st.chat_input("Ask a question about your document or anything els
 
     # Get response
     with st.chat_message("assistant"):
-        with st.spinner("Searching..."):
-            try:
-                # Initialize LLM
-                llm = ChatOpenAI(
-                    openai_api_key=openrouter_api_key,
-                    openai_api_base="https://openrouter.ai/api/v1",
-                    model_name=model_name,
-                    temperature=temperature,
-                    default_headers={
-                        "HTTP-Referer": "http://localhost:8501",
-                        "X-Title": "Agentic RAG System"
-                    }
-                )
-                
-                # Step 1: Search PDF first
-                pdf_context = None
-                if st.session_state.vectorstore:
-                    pdf_context = search_pdf(st.session_state.vectorstore, question)
-                
-                # Step 2: Search web (always, for supplementary info)
-                web_context = search_web(tavily_api_key, question)
-                
-                # Step 3: Generate answer
-                response = get_answer(llm, question, pdf_context, web_context)
-                
-                st.markdown(response)
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-                
-            except Exception as e:
-                error_msg = f"Error: {str(e)}"
-                st.error(error_msg)
-                st.session_state.chat_history.append({"role": "assistant", "content": error_msg})
+        try:
+            # Without a PDF the web search is always needed, so start it right away
+            tavily_client = get_tavily_client()
+            web_future = None
+            if st.session_state.vectorstore is None:
+                web_future = get_executor().submit(search_web, tavily_client, tavily_api_key, question)
+
+            # Get LLM (cached, so its connection pool is reused across turns)
+            llm = get_llm(openrouter_api_key, model_name, temperature)
+            
+            # Step 1 & 2: Search PDF first, then the web unless the PDF is a confident match
+            with st.spinner("Searching..."):
+                pdf_context, pdf_score = search_pdf(st.session_state.vectorstore, question)
+                web_context = None
+                if web_future is not None:
+                    web_context = web_future.result()
+                elif pdf_context is None or pdf_score < web_search_threshold:
+                    web_context = search_web(tavily_client, tavily_api_key, question)
+            
+            # Step 3: Stream the answer as it is generated
+            answer = st.write_stream(get_answer(llm, question, pdf_context, web_context))
+            
+            # Add source indicator
+            source_note = f"*Source: {get_source_label(pdf_context, web_context)}*"
+            st.markdown(source_note)
+            st.session_state.chat_history.append({"role": "assistant", "content": f"{answer}\n\n{source_note}"})
+            
+        except Exception as e:
+            error_msg = f"Error: {str(e)}"
+            st.error(error_msg)
+            st.session_state.chat_history.append({"role": "assistant", "content": error_msg})
 
 # Footer
 st.markdown("---")